@@ -0,0 +1,152 @@
+import sqlite3
+import json
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from fusion import FUSED_TOP_K, fuse_neighbor_ids
+
+# Path to the database with pre-computed neighbors (the same file the app reads)
+BOOKS_DB_PATH_WITH_RECS = "data/hybrid_recommendations.db"
+
+# Columnar copy of the books table that the app bulk-loads; SQLite is only used for title search
+BOOKS_PARQUET_PATH = "data/books.parquet"
+
+# Neighbor lists are stored as JSON text by the preprocessing notebook.
+# They are converted once into packed little-endian int32 BLOBs (100 neighbors = 400 bytes).
+NEIGHBOR_BLOB_COLUMNS = {
+    "similar_books_json": "similar_books_blob",
+    "top_desc_neighbors_ids_json": "top_desc_neighbors_blob",
+    "top_shelf_neighbors_ids_json": "top_shelf_neighbors_blob",
+}
+
+
+def pack_ids(ids):
+    return np.asarray(ids, dtype=np.int32).tobytes()
+
+
+def unpack_id_blobs(blobs, dtype=np.int32) -> list:
+    # Decode a whole column in one pass: a single frombuffer over the joined bytes,
+    # then split into per-book views that all share that one buffer.
+    blobs = list(blobs)
+    flat_ids = np.frombuffer(b"".join(blobs), dtype=dtype)
+    split_points = np.cumsum([len(b) // flat_ids.itemsize for b in blobs])[:-1]
+    return np.split(flat_ids, split_points)
+
+
+def build_neighbor_blobs(conn):
+    cursor = conn.cursor()
+    existing_columns = {row[1] for row in cursor.execute("PRAGMA table_info(books);")}
+
+    for json_col, blob_col in NEIGHBOR_BLOB_COLUMNS.items():
+        if json_col not in existing_columns:
+            continue # Already converted on a previous run
+
+        if blob_col not in existing_columns:
+            cursor.execute(f"ALTER TABLE books ADD COLUMN {blob_col} BLOB;")
+
+        rows = cursor.execute(f"SELECT rowid, {json_col} FROM books;").fetchall()
+        cursor.executemany(
+            f"UPDATE books SET {blob_col} = ? WHERE rowid = ?;",
+            ((pack_ids(json.loads(ids_json)), rowid) for rowid, ids_json in rows),
+        )
+        cursor.execute(f"ALTER TABLE books DROP COLUMN {json_col};")
+        print(f"Converted {json_col} -> {blob_col} ({len(rows)} rows)")
+
+    conn.commit()
+    conn.execute("VACUUM;") # Reclaim the space freed by the dropped JSON columns
+
+
+def build_fused_recommendations(conn):
+    # Run the Tier-1/Tier-2 fusion for every book once, so the app only has to gather rows.
+    # Ids are stored as int32 and their source codes as int8 (see fusion.py).
+    cursor = conn.cursor()
+    existing_columns = {row[1] for row in cursor.execute("PRAGMA table_info(books);")}
+    for blob_col in ("fused_top10_ids_blob", "fused_top10_sources_blob"):
+        if blob_col not in existing_columns:
+            cursor.execute(f"ALTER TABLE books ADD COLUMN {blob_col} BLOB;")
+
+    rows = cursor.execute(
+        "SELECT book_id, top_desc_neighbors_blob, top_shelf_neighbors_blob FROM books;"
+    ).fetchall()
+    catalog_ids = {row[0] for row in rows}
+
+    updates = []
+    for book_id, desc_blob, shelf_blob in rows:
+        fused_ids, fused_sources = fuse_neighbor_ids(
+            np.frombuffer(desc_blob, dtype=np.int32), np.frombuffer(shelf_blob, dtype=np.int32), FUSED_TOP_K
+        )
+        # Drop neighbors that are not in the catalog, keeping ids and sources aligned
+        in_catalog = np.array([bid in catalog_ids for bid in fused_ids.tolist()], dtype=bool)
+        updates.append((fused_ids[in_catalog].tobytes(), fused_sources[in_catalog].tobytes(), book_id))
+
+    cursor.executemany(
+        "UPDATE books SET fused_top10_ids_blob = ?, fused_top10_sources_blob = ? WHERE book_id = ?;",
+        updates,
+    )
+    conn.commit()
+    print(f"Precomputed top-{FUSED_TOP_K} fused recommendations ({len(updates)} books)")
+
+
+def build_title_fts(conn):
+    # External-content FTS5 table keyed by book_id. ratings_count/average_rating are carried
+    # UNINDEXED so the app's title search can read and order by them without joining books.
+    cursor = conn.cursor()
+    cursor.executescript("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_books_book_id ON books(book_id);
+        DROP TABLE IF EXISTS books_fts;
+        CREATE VIRTUAL TABLE books_fts USING fts5(
+            title,
+            ratings_count UNINDEXED,
+            average_rating UNINDEXED,
+            content='books',
+            content_rowid='book_id'
+        );
+        INSERT INTO books_fts(books_fts) VALUES('rebuild');
+    """)
+    conn.commit()
+    print("Rebuilt books_fts title index")
+
+
+def export_books_parquet(conn):
+    # Everything the app needs in one columnar file: 32-bit scalars and native list<int32>/list<int8>
+    # neighbor columns, so the app's bulk load never goes through per-row Python tuples or BLOB decoding.
+    rows = conn.execute("""
+        SELECT
+            book_id, title, average_rating, ratings_count,
+            top_desc_neighbors_blob, top_shelf_neighbors_blob, similar_books_blob,
+            fused_top10_ids_blob, fused_top10_sources_blob
+        FROM books
+        ORDER BY book_id;
+    """).fetchall()
+    (book_ids, titles, average_ratings, ratings_counts,
+     desc_blobs, shelf_blobs, similar_blobs, fused_id_blobs, fused_source_blobs) = zip(*rows)
+
+    int32_lists = pa.list_(pa.int32())
+    table = pa.table({
+        "book_id": pa.array(book_ids, type=pa.int32()),
+        "title": pa.array(titles, type=pa.string()),
+        "average_rating": pa.array(average_ratings, type=pa.float32()),
+        "ratings_count": pa.array(ratings_counts, type=pa.int32()),
+        "top_desc_neighbors_ids": pa.array(unpack_id_blobs(desc_blobs), type=int32_lists),
+        "top_shelf_neighbors_ids": pa.array(unpack_id_blobs(shelf_blobs), type=int32_lists),
+        "similar_books": pa.array(unpack_id_blobs(similar_blobs), type=int32_lists),
+        "fused_top10_ids": pa.array(unpack_id_blobs(fused_id_blobs), type=int32_lists),
+        "fused_top10_sources": pa.array(unpack_id_blobs(fused_source_blobs, dtype=np.int8), type=pa.list_(pa.int8())),
+    })
+    pq.write_table(table, BOOKS_PARQUET_PATH, compression="zstd")
+    print(f"Wrote {BOOKS_PARQUET_PATH} ({table.num_rows} books)")
+
+
+def main():
+    conn = sqlite3.connect(BOOKS_DB_PATH_WITH_RECS)
+    try:
+        build_neighbor_blobs(conn)
+        build_title_fts(conn)
+        build_fused_recommendations(conn) # Relies on the book_id index created by build_title_fts
+        export_books_parquet(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import numpy as np
+from numba import njit
+
+# Number of fused recommendations precomputed per book by build_app_db.py
+FUSED_TOP_K = 10
+
+# Source codes stored alongside each fused recommendation id
+SOURCE_DESCRIPTION = 0
+SOURCE_POPULAR_SHELVES = 1
+
+
+@njit(cache=True) # Compiled once and cached on disk; called for every book at build time
+def fuse_neighbor_ids(desc_ids, shelf_ids, k):
+    # Tier 1 (Description) then Tier 2 (Popular Shelves): keep the first occurrence
+    # of every id in that order, and stop as soon as k ids are collected.
+    out_ids = np.empty(k, dtype=np.int32)
+    out_sources = np.empty(k, dtype=np.int8)
+    seen = {np.int32(0): np.int8(0)} # Typed dict used as a set of already-added ids
+    seen.clear()
+    n = 0
+
+    for bid in desc_ids:
+        if n >= k:
+            break
+        if bid not in seen:
+            seen[np.int32(bid)] = np.int8(SOURCE_DESCRIPTION)
+            out_ids[n] = bid
+            out_sources[n] = SOURCE_DESCRIPTION
+            n += 1
+
+    for bid in shelf_ids:
+        if n >= k:
+            break
+        if bid not in seen:
+            seen[np.int32(bid)] = np.int8(SOURCE_POPULAR_SHELVES)
+            out_ids[n] = bid
+            out_sources[n] = SOURCE_POPULAR_SHELVES
+            n += 1
+
+    return out_ids[:n], out_sources[:n]
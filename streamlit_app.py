@@ -2,8 +2,10 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import sqlite3
-import json
-from rapidfuzz import process # You need to import this for fuzzy matching
+from rapidfuzz import process, fuzz # You need to import this for fuzzy matching
+from rapidfuzz.utils import default_process
+from sklearn.feature_extraction.text import TfidfVectorizer
+from fusion import FUSED_TOP_K, SOURCE_DESCRIPTION, fuse_neighbor_ids
 
 # --- Set Streamlit Page Configuration (MUST BE THE FIRST STREAMLIT COMMAND) ---
 st.set_page_config(page_title="Book Recommendation System", layout="wide")
@@ -11,66 +13,112 @@ st.set_page_config(page_title="Book Recommendation System", layout="wide")
 # Path to the NEW database with pre-computed neighbors
 BOOKS_DB_PATH_WITH_RECS = "data/hybrid_recommendations.db"
 
-@st.cache_data
+# Columnar copy of the books table written by build_app_db.py. Numeric columns are already
+# int32/float32 and neighbor lists are native list<int32> columns, so no decoding is needed here.
+BOOKS_PARQUET_PATH = "data/books.parquet"
+
+# Read-only connection tuning: memory-mapped reads, a 256 MB page cache, in-memory temp storage
+SQLITE_READ_PRAGMAS = """
+    PRAGMA mmap_size=268435456;
+    PRAGMA cache_size=-262144;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA query_only=1;
+"""
+
+# Title search straight from books_fts, which carries ratings_count/average_rating (see build_app_db.py).
+# Kept as one module-level string so the shared connection reuses its cached statement plan.
+SELECT_FTS_STMT = """
+    SELECT rowid, title, ratings_count, average_rating -- rowid is the book_id (content_rowid)
+    FROM books_fts
+    WHERE books_fts MATCH ?
+    ORDER BY ratings_count DESC
+    LIMIT ?;
+"""
+
+# Minimum cosine similarity for a TF-IDF title match; below this we fall back to RapidFuzz
+TFIDF_MIN_SIMILARITY = 0.3
+
+# Shared by reference across reruns and sessions (no pickle round-trip), so the returned
+# DataFrame is read-only: callers must copy before modifying anything derived from it.
+@st.cache_resource
 def load_app_data():
-    conn = None
     try:
-        conn = sqlite3.connect(BOOKS_DB_PATH_WITH_RECS)
-        books_df = pd.read_sql("""
-            SELECT
-                book_id,
-                title,              -- Use 'title' as it's the renamed/processed column
-                average_rating,
-                ratings_count,
-                similar_books_json,
-                top_desc_neighbors_ids_json,
-                top_shelf_neighbors_ids_json
-            FROM books
-        """, conn)
-
-        # Post-process JSON columns back into Python lists
-        books_df['similar_books_filtered'] = books_df['similar_books_json'].apply(json.loads)
-        books_df['top_desc_neighbors_ids'] = books_df['top_desc_neighbors_ids_json'].apply(json.loads)
-        books_df['top_shelf_neighbors_ids'] = books_df['top_shelf_neighbors_ids_json'].apply(json.loads)
-
-        books_df = books_df.drop(columns=[
-            'similar_books_json', 'top_desc_neighbors_ids_json', 'top_shelf_neighbors_ids_json'
+        # Only the columns the app uses; similar_books stays in the file but is never read
+        books_df = pd.read_parquet(BOOKS_PARQUET_PATH, engine='pyarrow', columns=[
+            'book_id', 'title', 'average_rating', 'ratings_count',
+            'top_desc_neighbors_ids', 'top_shelf_neighbors_ids',
+            'fused_top10_ids', 'fused_top10_sources'
         ])
+
+        # Index on book_id so .loc lookups hit the index hashtable instead of a full-table mask
+        books_df = books_df.set_index('book_id', drop=False).sort_index()
         st.success("Main books data with precomputed neighbors loaded.")
         return books_df # Ensure you return the DataFrame
 
     except FileNotFoundError as e:
-        st.error(f"Error loading main database: {e}. Ensure '{BOOKS_DB_PATH_WITH_RECS}' is correct.")
+        st.error(f"Error loading main books data: {e}. Ensure '{BOOKS_PARQUET_PATH}' exists (run build_app_db.py).")
         st.stop()
     except Exception as e:
         st.error(f"An unexpected error occurred loading data from DB: {e}")
         st.stop()
-    finally:
-        if conn: conn.close()
 
 
 books_df = load_app_data()
 
 
 
-@st.cache_data # Cache search results
-def search_books_streamlit(title_query_str: str, conn_path: str, books_df_full: pd.DataFrame, top_n: int = 5):
-    conn = None
-    conn = sqlite3.connect(conn_path)
-    cursor = conn.cursor()
+@st.cache_resource # One tuned, read-only connection shared across reruns and sessions
+def get_conn():
+    conn = sqlite3.connect(BOOKS_DB_PATH_WITH_RECS, check_same_thread=False)
+    conn.executescript(SQLITE_READ_PRAGMAS)
+    return conn
+
+
+@st.cache_resource # Built once and shared by every fuzzy search
+def get_title_corpus():
+    # Titles are already in memory in books_df, so there is no need to scan the books table again
+    titles = books_df['title'].to_list()
+    # Normalize every title once so process.extract can run with processor=None on each query
+    processed_titles = tuple(default_process(title) for title in titles)
+    book_ids = books_df['book_id'].to_numpy()
+    return titles, processed_titles, book_ids
+
+
+@st.cache_resource # Fit once; each query is then a single sparse mat-vec
+def get_title_tfidf_index():
+    titles, _, _ = get_title_corpus()
+    vectorizer = TfidfVectorizer(analyzer='char_wb', ngram_range=(3, 5))
+    title_matrix = vectorizer.fit_transform(titles) # Rows are L2-normalized, so X @ q.T is cosine similarity
+    return vectorizer, title_matrix
+
+
+def tfidf_title_matches(title_query_str: str, top_n: int):
+    vectorizer, title_matrix = get_title_tfidf_index()
+    query_vec = vectorizer.transform([title_query_str])
+    scores = (title_matrix @ query_vec.T).toarray().ravel()
+
+    if len(scores) > top_n:
+        top_idx = np.argpartition(-scores, top_n)[:top_n]
+    else:
+        top_idx = np.arange(len(scores))
+    return top_idx[scores[top_idx] >= TFIDF_MIN_SIMILARITY] # Corpus positions of the confident matches
+
+
+def fts_escape(title_query_str: str) -> str:
+    # Quote every token (dropping stray double quotes) so FTS5 operators in user input can't
+    # break the query, and make each one a prefix match so partial titles still hit the index.
+    tokens = [tok.replace('"', '') for tok in title_query_str.split()]
+    return ' '.join(f'"{tok}"*' for tok in tokens if tok) or '""'
 
-    fts5_query_str = f'"{title_query_str}"' 
 
-        # 1. Direct FTS5 search (using title as indexed)
-    sql_fts = """
-        SELECT b.book_id, b.title, b.ratings_count, b.average_rating -- Removed b.authors
-        FROM books_fts fts
-        JOIN books b ON b.rowid = fts.rowid
-        WHERE books_fts MATCH ?
-        ORDER BY b.ratings_count DESC
-        LIMIT ?;
-    """
-    cursor.execute(sql_fts, (fts5_query_str, top_n)) # Pass top_n to LIMIT
+@st.cache_data(show_spinner=False, max_entries=256) # Cache key is just (query, top_n)
+def search_books_streamlit(title_query_str: str, top_n: int = 5):
+    cursor = get_conn().cursor()
+
+    fts5_query_str = fts_escape(title_query_str)
+
+    # 1. Direct FTS5 search
+    cursor.execute(SELECT_FTS_STMT, (fts5_query_str, top_n)) # Pass top_n to LIMIT
     fts_results = cursor.fetchall()
 
     formatted_results = []
@@ -81,21 +129,23 @@ def search_books_streamlit(title_query_str: str, conn_path: str, books_df_full:
     if formatted_results:
         return formatted_results
     else:
-        cursor.execute("SELECT title FROM books;")
-        all_titles = [row[0] for row in cursor.fetchall()]
-        fuzzy_matches = process.extract(title_query_str, all_titles, limit=top_n)
-        matched_titles = [match[0] for match in fuzzy_matches]
-
-        query = f"""
-            SELECT book_id, title, ratings_count, average_rating
-            FROM books
-            WHERE title IN ({','.join(['?']*len(matched_titles))})
-            ORDER BY ratings_count DESC
-            LIMIT ?;
-        """
-        cursor.execute(query, (*matched_titles, top_n))
-        results = cursor.fetchall()
-    conn.close()
+        # 2. Character n-gram TF-IDF match, then RapidFuzz only if nothing scores well enough
+        _, processed_titles, book_ids = get_title_corpus()
+        matched_idx = tfidf_title_matches(title_query_str, top_n)
+        if matched_idx.size == 0:
+            fuzzy_matches = process.extract(
+                default_process(title_query_str), processed_titles,
+                scorer=fuzz.WRatio, processor=None, limit=top_n
+            )
+            # Each match is (choice, score, index)
+            matched_idx = [match[2] for match in fuzzy_matches]
+
+        # Gather the matched books from the in-memory DataFrame
+        matched_ids = book_ids[matched_idx]
+        result_df = books_df.loc[matched_ids].nlargest(top_n, 'ratings_count')[
+            ['book_id', 'title', 'ratings_count', 'average_rating']
+        ]
+        results = list(result_df.itertuples(index=False, name=None))
 
     return results
 
@@ -104,56 +154,42 @@ def search_books_streamlit(title_query_str: str, conn_path: str, books_df_full:
 
 
 # --- Recommendation Fusion Function (SIMPLIFIED & OPTIMIZED) ---
+# Pure in (query_book_id, k): books_df is a read-only cache_resource, so results never go stale
+@st.cache_data(max_entries=1024, show_spinner=False)
 def fuse_neighbors_streamlit(query_book_id: int, k: int = 10):
-    query_book_row = books_df[books_df['book_id'] == query_book_id]
-    if query_book_row.empty:
+    if query_book_id not in books_df.index:
         st.warning(f"Query book ID {query_book_id} not found in main DataFrame for recommendation fusion.")
         return pd.DataFrame()
-    query_book_row = query_book_row.iloc[0] # Get the single row (as a Series)
+    query_book_row = books_df.loc[query_book_id] # Get the single row (as a Series)
 
-    desc_list_ordered = query_book_row['top_desc_neighbors_ids']
-    shelf_list_ordered = query_book_row['top_shelf_neighbors_ids']
-    
-    fused_recommendations_ids = []
-    fused_recommendations_sources = []
-    added_ids_set = set() # To ensure uniqueness
-
-    # Tier 1: Fill from Description
-    for bid in desc_list_ordered:
-        if bid not in added_ids_set:
-            fused_recommendations_ids.append(bid)
-            fused_recommendations_sources.append("Source: Description")
-            added_ids_set.add(bid)
-            if len(fused_recommendations_ids) >= k:
-                break
-    
-    # Tier 2: Fill remaining spots from Popular Shelves
-    if len(fused_recommendations_ids) < k:
-        for bid in shelf_list_ordered:
-            if bid not in added_ids_set:
-                fused_recommendations_ids.append(bid)
-                fused_recommendations_sources.append("Source: Popular Shelves")
-                added_ids_set.add(bid)
-                if len(fused_recommendations_ids) >= k:
-                    break
-
-    if not fused_recommendations_ids:
-        return pd.DataFrame()
+    if k <= FUSED_TOP_K:
+        # Precomputed at build time (see build_app_db.py), already deduplicated and catalog-filtered
+        fused_recommendations_ids = query_book_row['fused_top10_ids'][:k]
+        fused_source_codes = query_book_row['fused_top10_sources'][:k]
+    else:
+        fused_recommendations_ids, fused_source_codes = fuse_neighbor_ids(
+            query_book_row['top_desc_neighbors_ids'], query_book_row['top_shelf_neighbors_ids'], k
+        )
+        # Skip any neighbor that is not in the catalog, keeping ids and sources aligned
+        in_catalog = books_df.index.get_indexer(fused_recommendations_ids) >= 0
+        fused_recommendations_ids = fused_recommendations_ids[in_catalog]
+        fused_source_codes = fused_source_codes[in_catalog]
 
-    matched_df = books_df[books_df["book_id"].isin(fused_recommendations_ids)].copy()
+    if fused_recommendations_ids.size == 0:
+        return pd.DataFrame()
 
-    rank_map = {bid: i for i, bid in enumerate(fused_recommendations_ids)}
-    matched_df["_rank"] = matched_df["book_id"].map(rank_map)
-    matched_df = matched_df.sort_values("_rank").reset_index(drop=True)
+    fused_recommendations_sources = np.where(
+        fused_source_codes == SOURCE_DESCRIPTION, "Source: Description", "Source: Popular Shelves"
+    )
 
-    source_map = {fused_recommendations_ids[i]: fused_recommendations_sources[i]
-                  for i in range(len(fused_recommendations_ids))}
-    matched_df["source"] = matched_df["book_id"].map(source_map)
+    # .loc[list] returns rows in the requested (fused) order, so ids and sources are already aligned.
+    # Gather only the display columns instead of copying the neighbor-list columns too.
+    matched_df = books_df.loc[fused_recommendations_ids, ["title", "average_rating", "ratings_count"]].copy()
+    matched_df["book_id"] = fused_recommendations_ids
+    matched_df["source"] = fused_recommendations_sources
 
     # Return final desired columns, now without "authors"
-    return matched_df[[
-        "title", "average_rating", "ratings_count", "book_id", "source"
-    ]]
+    return matched_df.reset_index(drop=True)
 
 
 def main():
@@ -182,7 +218,7 @@ def main():
     if st.button("Get Recommendations"): # Button to trigger the search
         if search_title:
             with st.spinner(f"Searching for '{search_title}'..."):
-                matched_books_results = search_books_streamlit(search_title, BOOKS_DB_PATH_WITH_RECS, books_df, top_n=5)
+                matched_books_results = search_books_streamlit(search_title, top_n=5)
                 st.session_state.search_results = matched_books_results # Store results in session state
                 st.session_state.selected_book_id = None # Reset selected book on new search
                 st.session_state.selected_book_title = None
@@ -217,7 +253,7 @@ def main():
         # --- Recommendation Generation and Display (Conditional on selection) ---
         if selected_book_id_from_selectbox is not None:
             # Update session state with the current selected book (from selectbox)
-            current_selected_book_row = books_df[books_df['book_id'] == selected_book_id_from_selectbox].iloc[0]
+            current_selected_book_row = books_df.loc[selected_book_id_from_selectbox]
             st.session_state.selected_book_id = current_selected_book_row['book_id']
             st.session_state.selected_book_title = current_selected_book_row['title']
             